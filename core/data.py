@@ -32,18 +32,51 @@ class ActigraphDataset(Dataset):
         y = self.y[index]
         return X, y
 
+class CUDAPrefetcher:
+    '''
+    Iterates over a dataloader while copying the next batch to the gpu on a
+    side cuda stream, overlapping the host to device transfer of the next
+    batch with compute on the current one. Most effective when the wrapped
+    dataloader uses `pin_memory=True`.
+    '''
+    def __init__(self, dataloader: DataLoader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        batch = None
+        for X, y in self.dataloader:
+            # issue the copy on the side stream before yielding the previous batch
+            with torch.cuda.stream(self.stream):
+                next_batch = (X.to(self.device, non_blocking=True),
+                              y.to(self.device, non_blocking=True))
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for tensor in next_batch:
+                tensor.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
 def create_dataloaders(X_train: pd.DataFrame, X_test: pd.DataFrame, y_train: list, y_test: list,
-                         shuffle: bool, batch_size: int):
+                         shuffle: bool, batch_size: int, eval_batch_size: int = None):
     '''
     Wraps train / test dataframes of any data format into a dataloader
 
     Args
-    - X_train - train dataframe 
+    - X_train - train dataframe
     - X_test - test dataframe
     - y_train - train labels
     - y_test - test labels
     - shuffle - shuffle dataset when creating dataloaders
-    - batch_size - batch size of dataloaders
+    - batch_size - batch size of the train dataloader
+    - eval_batch_size - batch size of the test dataloader, defaults to the whole
+      test set so evaluation runs as a single forward pass
 
     Returns
     - (DataLoader, DataLoader) tuple of train and test dataloaders
@@ -58,8 +91,13 @@ def create_dataloaders(X_train: pd.DataFrame, X_test: pd.DataFrame, y_train: lis
     # wrap in pytorch dataloader
     train_dataset = ActigraphDataset(X_train, y_train)
     test_dataset = ActigraphDataset(X_test, y_test)
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle)
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=shuffle)
+    if eval_batch_size is None:
+        eval_batch_size = len(test_dataset)
+    # pinned host memory is required for non_blocking copies (and hence the
+    # CUDAPrefetcher's transfer/compute overlap) to actually be asynchronous
+    pin_memory = torch.cuda.is_available()
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+    test_dataloader = DataLoader(test_dataset, batch_size=eval_batch_size, shuffle=shuffle, pin_memory=pin_memory)
 
     return (train_dataloader, test_dataloader)
 
@@ -24,7 +24,6 @@ def _train_step(model: torch.nn, dataloader: DataLoader, optimizer, criterion, d
 
         # forward pass
         out = model(X)
-        preds = out.squeeze().sigmoid().round()
 
         # calculate loss
         loss = criterion(out.squeeze(), y)
@@ -62,7 +61,6 @@ def _test_step(model: torch.nn, dataloader: DataLoader, criterion, device):
 
             # forward pass
             out = model(X)
-            preds = out.squeeze().sigmoid().round()
 
             # calculate loss
             loss = criterion(out.squeeze(), y)
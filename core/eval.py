@@ -1,81 +1,178 @@
 import numpy as np
 import pandas as pd
 import torch
+from torch.nn import functional as F
 from torch.utils.data import DataLoader
 from sklearn.calibration import CalibratedClassifierCV
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import precision_score, recall_score, f1_score, precision_recall_fscore_support, matthews_corrcoef
+from core.data import CUDAPrefetcher
 
-LABELS = ['model_name', 'note', 'loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1']
+LABELS = ['model_name', 'note', 'loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1', 'mcc']
 
-def eval_model(model: torch.nn, dataloader: DataLoader, criterion: torch.nn, device, note:str=None):
+def _bce_with_logits(logits: np.ndarray, targets: np.ndarray, pos_weight: float = 1.0):
+    '''
+    Numerically stable binary cross entropy with logits in numpy, matching
+    nn.BCEWithLogitsLoss with mean reduction.
+
+    Args
+    - logits - array of raw model outputs
+    - targets - array of 0/1 labels
+    - pos_weight - weight applied to the positive class term
+
+    Returns
+    - the mean loss as a float
+    '''
+    losses = pos_weight * targets * np.logaddexp(0, -logits) + (1 - targets) * np.logaddexp(0, logits)
+    return losses.mean()
+
+def _confusion_counts(y_true, y_pred):
+    '''
+    Computes per class confusion matrix counts for 0/1 labels as vectorized
+    numpy boolean reductions over the whole arrays.
+
+    Args
+    - y_true - arraylike of true 0/1 labels
+    - y_pred - arraylike of predicted 0/1 labels
+
+    Returns
+    - (tp, fp, fn) count arrays of shape (2,)
+    '''
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    tp = np.array([((y_pred==0) & (y_true==0)).sum(), ((y_pred==1) & (y_true==1)).sum()])
+    fp = np.array([((y_pred==0) & (y_true==1)).sum(), ((y_pred==1) & (y_true==0)).sum()])
+    fn = np.array([((y_pred==1) & (y_true==0)).sum(), ((y_pred==0) & (y_true==1)).sum()])
+    return tp, fp, fn
+
+def _metrics_from_counts(tp: np.ndarray, fp: np.ndarray, fn: np.ndarray):
+    '''
+    Derives per class precision, recall, and f1 score from confusion matrix counts,
+    along with the matthews correlation coefficient for the positive class.
+    Divisions by zero produce nan, matching sklearn's `zero_division=np.nan`.
+
+    Args
+    - tp - true positive counts per class, shape (2,)
+    - fp - false positive counts per class, shape (2,)
+    - fn - false negative counts per class, shape (2,)
+
+    Returns
+    - (precision, recall, fscore, mcc) with per class arrays of shape (2,)
+    '''
+    tp, fp, fn = tp.astype(np.float64), fp.astype(np.float64), fn.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), np.nan)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), np.nan)
+        # sklearn computes f1 from the counts directly, so it is 0.0 (not nan)
+        # whenever any of tp, fp, fn is nonzero, even if precision or recall is nan
+        fscore = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), np.nan)
+
+    # mcc for the binary case, where class 0's true positives are class 1's true negatives
+    tn = tp[0]
+    denominator = np.sqrt((tp[1] + fp[1]) * (tp[1] + fn[1]) * (tn + fp[1]) * (tn + fn[1]))
+    mcc = (tp[1] * tn - fp[1] * fn[1]) / denominator if denominator > 0 else 0.0
+
+    return precision, recall, fscore, mcc
+
+class StreamingBinaryMetrics:
+    '''
+    Streaming binary classification metrics in the style of torchmetrics:
+    `update` accumulates on-device confusion matrix counts per batch, and
+    `compute` reduces them to the final metrics once at the end.
+    '''
+    def __init__(self, device):
+        self.tp = torch.zeros(2, dtype=torch.int64, device=device)
+        self.fp = torch.zeros(2, dtype=torch.int64, device=device)
+        self.fn = torch.zeros(2, dtype=torch.int64, device=device)
+
+    def update(self, preds: torch.Tensor, y: torch.Tensor):
+        '''
+        Accumulates the confusion matrix counts of a batch of 0/1 predictions.
+        '''
+        self.tp[0] += ((preds==0) & (y==0)).sum()
+        self.fp[0] += ((preds==0) & (y==1)).sum()
+        self.fn[0] += ((preds==1) & (y==0)).sum()
+        self.tp[1] += ((preds==1) & (y==1)).sum()
+        self.fp[1] += ((preds==1) & (y==0)).sum()
+        self.fn[1] += ((preds==0) & (y==1)).sum()
+
+    def compute(self):
+        '''
+        Transfers the counts to the host in one go and derives the metrics.
+
+        Returns
+        - (precision, recall, fscore, support, mcc) with per class arrays of shape (2,)
+        '''
+        tp, fp, fn = self.tp.cpu().numpy(), self.fp.cpu().numpy(), self.fn.cpu().numpy()
+        support = tp + fn
+        precision, recall, fscore, mcc = _metrics_from_counts(tp, fp, fn)
+        return precision, recall, fscore, support, mcc
+
+def eval_model(model: torch.nn, dataloader: DataLoader, criterion: torch.nn, device, note:str=None, compile_model:bool=False):
     '''
     Evaluate pytorch model performance on the test dataset.
 
     Args
     - model - pytorch nn model
     - dataloader - test data
-    - criterion - loss function
+    - criterion - loss function, only read for its pos_weight
     - device - 'cpu' or 'cuda'
     - note - miscelaneous information about the evaluation
+    - compile_model - compile the model with torch.compile before evaluating
+      (the first batch pays a one-time compilation cost)
 
     Returns
-    - a series containing model results with loss, accuracy, precision, recall, f1score, and number of samples per class 
+    - a series containing model results with loss, accuracy, precision, recall, f1score, and number of samples per class
     '''
-    test_loss = 0
-    test_acc = 0
-    test_precision = [0 for _ in range(2)]
-    test_recall = [0 for _ in range(2)]
-    test_fscore = [0 for _ in range(2)]
-    test_support = [0 for _ in range(2)]
-    test_mcc = 0
-
     model_name = type(model).__name__
-    
+
+    # overlap host to device copies with model compute on cuda, and run the
+    # forward pass in bfloat16 to halve activation bandwidth / use tensor cores
+    use_cuda = torch.cuda.is_available() and str(device).startswith('cuda')
+    if use_cuda:
+        dataloader = CUDAPrefetcher(dataloader, device)
+
+    # running loss, correct count, and streaming classification metrics,
+    # kept on-device until after the loop to avoid per batch host syncs
+    test_loss = torch.zeros((), device=device)
+    test_correct = torch.zeros((), dtype=torch.int64, device=device)
+    test_total = 0
+    metrics = StreamingBinaryMetrics(device)
+
     model.eval()
+    if compile_model:
+        # reduce-overhead uses cuda graphs to remove per-op launch overhead,
+        # which matters most for the small batches used here
+        model = torch.compile(model, mode='reduce-overhead')
     with torch.inference_mode():
         for _, (X, y) in enumerate(dataloader):
             X, y = X.to(device), y.to(device)
 
-            # forward pass
-            out = model(X)
-            preds = out.squeeze().sigmoid().round()
+            # forward pass, cast back to fp32 so loss numerics are unchanged
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_cuda):
+                out = model(X)
+            out = out.float().squeeze()
+            # sigmoid(x).round() == 1 exactly when the logit is positive
+            preds = (out > 0).float()
 
-            # calculate loss
-            loss = criterion(out.squeeze(), y)
+            # calculate loss with the fused functional form, keeping the
+            # criterion's class weighting
+            loss = F.binary_cross_entropy_with_logits(out, y, pos_weight=getattr(criterion, 'pos_weight', None))
 
             # aggregate metrics
-            test_loss += loss.item()
-            test_acc += ((preds==y).sum() / len(y)).item()
-
-            precision, recall, fscore, support = precision_recall_fscore_support(y.cpu(), preds.cpu(), zero_division=np.nan)
-            
-            test_precision[0] += precision[0] if len(precision) > 0 else 0
-            test_precision[1] += precision[1] if len(precision) > 1 else 0
-            test_recall[0] += recall[0] if len(recall) > 0 else 0
-            test_recall[1] += recall[1] if len(recall) > 1 else 0
-            test_fscore[0] += fscore[0] if len(fscore) > 0 else 0
-            test_fscore[1] += fscore[1] if len(fscore) > 1 else 0
-            test_support[0] += support[0] if len(support) > 0  else 0
-            test_support[1] += support[1] if len(support) > 1  else 0
-
-            test_mcc += matthews_corrcoef(y.cpu(), preds.cpu())
+            test_loss += loss.detach()
+            test_correct += (preds==y).sum()
+            test_total += len(y)
+
+            metrics.update(preds, y)
+
+    # single device to host transfer, then closed-form metrics over the whole epoch
+    test_precision, test_recall, test_fscore, test_support, test_mcc = metrics.compute()
 
     # calculate average metrics
-    test_loss /= len(dataloader)
-    test_acc /= len(dataloader)
-    test_precision[0] /= len(dataloader)
-    test_precision[1] /= len(dataloader)
-    test_recall[0] /= len(dataloader)
-    test_recall[1] /= len(dataloader)
-    test_fscore[0] /= len(dataloader)
-    test_fscore[1] /= len(dataloader)
-    test_mcc /= len(dataloader)
-
-    LABELS = ['model_name', 'note', 'loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1', 'mcc']
-    results = pd.Series([model_name, note, test_loss, test_acc, test_precision[0], test_precision[1], test_recall[0], test_recall[1],
-                        test_fscore[0], test_fscore[1], test_support[0], test_support[1], test_mcc])
-    results.index = LABELS
+    test_loss = test_loss.item() / len(dataloader)
+    test_acc = test_correct.item() / test_total
+
+    results = pd.Series(dict(zip(LABELS, [model_name, note, test_loss, test_acc, test_precision[0], test_precision[1],
+                        test_recall[0], test_recall[1], test_fscore[0], test_fscore[1], test_support[0], test_support[1], test_mcc])))
     return results
 
 def eval_sklearn_model(model, X_test: pd.DataFrame, y_test: list, criterion: torch.nn, device : str = None, note=None):
@@ -86,8 +183,8 @@ def eval_sklearn_model(model, X_test: pd.DataFrame, y_test: list, criterion: tor
     - model - sklearn model class
     - X_test - test input data
     - y_test - test labels
-    - criterion - loss function
-    - device - 'cpu' or 'cuda'
+    - criterion - loss function, only read for its pos_weight
+    - device - unused, kept for call site compatibility
     - note - miscelaneous information about the evaluation
 
     Returns
@@ -97,25 +194,22 @@ def eval_sklearn_model(model, X_test: pd.DataFrame, y_test: list, criterion: tor
     out = model.predict_proba(X_test)
     
     y_prob = out[:,1]
-    y_prob_tensor = torch.tensor(y_prob).float()
     y_pred = y_prob.round()
-    y_test_tensor = torch.tensor(y_test).float()
-    if device:
-        y_prob_tensor = y_prob_tensor.to(device)
-        y_test_tensor = y_test_tensor.to(device)
-
-    test_loss = criterion(y_prob_tensor, y_test_tensor).item()
-    test_acc = (y_pred == y_test).sum() / len(y_test)
-    test_precision, test_recall, test_fscore, test_support = precision_recall_fscore_support(
-                                                    y_true = torch.tensor(y_test),
-                                                    y_pred = torch.tensor(y_pred),
-                                                    zero_division=np.nan)
-    test_mcc = matthews_corrcoef(y_true=y_test, y_pred=y_pred)
-    
-    LABELS = ['model_name', 'note', 'loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1', 'mcc']
-    results = pd.Series([model_name, note, test_loss, test_acc, test_precision[0], test_precision[1], test_recall[0], test_recall[1],
-                        test_fscore[0], test_fscore[1], test_support[0], test_support[1], test_mcc])
-    results.index = LABELS
+
+    # compute the loss directly in numpy; no tensor wrapping or device
+    # transfer needed for a handful of elementwise ops on host arrays
+    pos_weight = 1.0
+    if getattr(criterion, 'pos_weight', None) is not None:
+        pos_weight = criterion.pos_weight.item()
+    y_true = np.asarray(y_test, dtype=np.float64)
+    test_loss = _bce_with_logits(y_prob, y_true, pos_weight)
+    test_acc = np.mean(y_pred == y_true)
+    tp, fp, fn = _confusion_counts(y_true, y_pred)
+    test_support = tp + fn
+    test_precision, test_recall, test_fscore, test_mcc = _metrics_from_counts(tp, fp, fn)
+
+    results = pd.Series(dict(zip(LABELS, [model_name, note, test_loss, test_acc, test_precision[0], test_precision[1],
+                        test_recall[0], test_recall[1], test_fscore[0], test_fscore[1], test_support[0], test_support[1], test_mcc])))
     return results
 
 
@@ -135,36 +229,29 @@ def append_weighted_average(metrics_df: pd.DataFrame):
     SUP0 = 'sup0'
     SUP1 = 'sup1'
 
-    # compute weighted averages
-
-    weighted_avg_metrics = [metrics_df.loc[0,'model_name'], "wt_avg"]
-    for metric_name in metric_names:
-
-        # set unweighted metric values (ie loss, accuracy)
-
-        sample_count = len(metrics_df)
-        weighted_metrics = metrics_df[metric_name]
-
-        # apply weights to base values if applicable
+    # build a folds x metrics weight matrix: the class supports for class
+    # specific metrics, ones for unweighted metrics (ie loss, accuracy)
 
+    values = metrics_df[metric_names].to_numpy(dtype=np.float64)
+    weights = np.ones_like(values)
+    for j, metric_name in enumerate(metric_names):
         if metric_name[-1] == "0":
-            weighted_metrics = metrics_df[metric_name] * metrics_df[SUP0]
-            sample_count = metrics_df[SUP0].sum()
+            weights[:, j] = metrics_df[SUP0]
         elif metric_name[-1] == "1":
-            weighted_metrics = metrics_df[metric_name] * metrics_df[SUP1]
-            sample_count = metrics_df[SUP1].sum()
+            weights[:, j] = metrics_df[SUP1]
 
-        # calculate average
+    # compute all weighted averages in one vectorized reduction over the folds;
+    # nansum skips nan fold metrics like the pandas Series.sum it replaced,
+    # while the denominator still counts every fold
+
+    weighted_avgs_values = np.nansum(values * weights, axis=0) / weights.sum(axis=0)
+    weighted_avg_metrics = [metrics_df.loc[0,'model_name'], "wt_avg"] + list(weighted_avgs_values)
 
-        weighted_avg = weighted_metrics.sum() / sample_count
-        weighted_avg_metrics.append(weighted_avg)
-    
-    # create and append row to dataframe
 
-    LABELS = ['model_name', 'note', 'loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1', 'mcc']
-    weighted_avgs = pd.Series(weighted_avg_metrics).to_frame().transpose()
-    weighted_avgs.columns = LABELS
-    metrics_df = pd.concat([metrics_df, weighted_avgs], axis=0, ignore_index=True)
+    # append the row to the copied dataframe directly instead of building a
+    # one row frame and concatenating, which would copy everything again
+
+    metrics_df.loc[len(metrics_df)] = weighted_avg_metrics
     #metrics_df = metrics_df.drop(labels=['loss'], axis=1)
 
     return metrics_df
@@ -179,18 +266,16 @@ def combine_several_weighted_averages(metric_dataframes: list):
     Returns
     - a dataframe of all weighted averages and the mean of those runs
     '''
-    wt_avg_list = []
-    for i, df in enumerate(metric_dataframes):
-        wt_avg = df[df['note'] == 'wt_avg']
-        wt_avg['note'] = f'{i+1}_wt_avg'
-        wt_avg_list.append(wt_avg)
-    new_df = pd.concat(wt_avg_list, axis=0)
+    # concatenate once and filter the weighted average row of every run
+    new_df = pd.concat(metric_dataframes, axis=0, ignore_index=True)
+    new_df = new_df[new_df['note'] == 'wt_avg'].reset_index(drop=True)
+    new_df['note'] = [f'{i+1}_wt_avg' for i in range(len(new_df))]
 
+    # append the mean of every metric column across the runs as a final row
     new_df_means = new_df.iloc[-1].copy()
     new_df_means['note'] = 'wt_avg'
-    for col in ['loss', 'acc', 'prec0', 'prec1', 'rec0', 'rec1', 'f1sc0', 'f1sc1', 'sup0', 'sup1', 'mcc']:
-        new_df_means.loc[col] = new_df[col].mean()
-    new_df = pd.concat([new_df, pd.DataFrame(new_df_means).transpose()], axis=0)
+    new_df_means[LABELS[2:]] = new_df[LABELS[2:]].mean()
+    new_df.loc[len(new_df)] = new_df_means
     return new_df
 
 def create_metrics_table(metric_dataframes: list):
@@ -231,8 +316,7 @@ def metric_class_averages(metric_df : pd.DataFrame):
     '''
 
     # calculate class ratio
-    support_values = metric_df[['sup0', 'sup1']].copy()
-    support_ratio = (support_values['sup0'] / support_values['sup1']).item()
+    support_ratio = (metric_df['sup0'] / metric_df['sup1']).item()
 
     def remove_end_digit(x:str):
         if len(x) == 0:
@@ -241,30 +325,31 @@ def metric_class_averages(metric_df : pd.DataFrame):
             return x[:-1]
         return x
 
-    # separate 0 and 1 class rows
+    # strip the class digit from every column name once, up front
+    renamed_columns = {c: remove_end_digit(c) for c in metric_df.columns}
+
+    # separate 0 and 1 class rows; filter + rename already return new frames,
+    # so no defensive .copy() is needed before assigning the note column
     columns_0 = [c for c in metric_df.columns if c[-1] != '1']
-    metric_0 = metric_df[columns_0].copy()
-    metric_0.columns = [remove_end_digit(c) for c in metric_0.columns]
+    metric_0 = metric_df.filter(items=columns_0).rename(columns=renamed_columns)
     metric_0['note'] = 0
-    
+
     columns_1 = [c for c in metric_df.columns if c[-1] != '0']
-    metric_1 = metric_df[columns_1].copy()
-    metric_1.columns = [remove_end_digit(c) for c in metric_1.columns]
+    metric_1 = metric_df.filter(items=columns_1).rename(columns=renamed_columns)
     metric_1['note'] = 1
 
     metrics_new = pd.concat([metric_0, metric_1], axis=0)
 
-    def weighted_avg(x:pd.Series, ratio:float):
-        val = x.iloc[0]
-        if isinstance(val, (int, float)) == False:
-            return pd.Series([val, val])
-        weighted_avg = (x.iloc[0] * ratio + x.iloc[1]) / (1 + ratio)
-        macro_avg = (x.iloc[0] + x.iloc[1]) / 2
-        return pd.Series([macro_avg, weighted_avg])
-
+    # calculate macro and weighted averages over the numeric columns with
+    # numpy reductions; non numeric columns carry the class 0 row's values
+    numeric_cols = [c for c in metrics_new.columns if isinstance(metrics_new[c].iloc[0], (int, float))]
+    values = metrics_new[numeric_cols].to_numpy(dtype=np.float64)
+    macro_avg = values.mean(axis=0)
+    weighted_avg = (values[0] * support_ratio + values[1]) / (1 + support_ratio)
 
-    # calculate weighted average
-    metric_avg = metrics_new.apply(weighted_avg, axis=0, args=(support_ratio,))
+    metric_avg = metrics_new.iloc[[0, 0]].reset_index(drop=True)
+    metric_avg.loc[0, numeric_cols] = macro_avg
+    metric_avg.loc[1, numeric_cols] = weighted_avg
     metric_avg['note'] = pd.Series(['macro_avg', 'wt_avg'])
     metrics_new = pd.concat([metrics_new, metric_avg], axis=0)
     return metrics_new